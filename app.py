@@ -1,30 +1,68 @@
 import os
+import re
+import asyncio
+import logging
 import json
+import math
 import time
+import queue
+import hmac
+import hashlib
 import sqlite3
 import secrets
-from datetime import datetime, timezone, timedelta
-from typing import Optional, List, Dict, Any
-
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Set, Any
+
+import orjson
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import PlainTextResponse, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response, PlainTextResponse, HTMLResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
 DB_PATH = os.getenv("DB_PATH", "/data/antibot.db")
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# храним sha256 токена: compare_digest всегда сравнивает два 32-байтных буфера,
+# так что по времени ответа не видно даже длину токена
+_ADMIN_TOKEN_DIGEST = hashlib.sha256(ADMIN_TOKEN.encode()).digest()
 CAPTCHA_TTL_SEC = int(os.getenv("CAPTCHA_TTL_SEC", "600"))  # 10 минут
+# ключ подписи капчи; если не задан — случайный на процесс (после рестарта выданные капчи недействительны)
+CAPTCHA_SECRET = (os.getenv("CAPTCHA_SECRET", "") or secrets.token_hex(32)).encode()
 
 # пороги
 CAPTCHA_SCORE_THRESHOLD = int(os.getenv("CAPTCHA_SCORE_THRESHOLD", "40"))
 ALERT_SCORE_THRESHOLD = int(os.getenv("ALERT_SCORE_THRESHOLD", "60"))
 
-# сколько дней хранить события (чтобы БД не пухла)
+# сколько дней хранить события и алерты (чтобы БД не пухла)
 EVENTS_TTL_DAYS = int(os.getenv("EVENTS_TTL_DAYS", "14"))
-
-app = FastAPI(title="antibot")
+# алерты — журнал для админки, по умолчанию не трогаем (0 = хранить всегда)
+ALERTS_TTL_DAYS = int(os.getenv("ALERTS_TTL_DAYS", "0"))
+# как часто фоновой задачей чистить старое (а не только при старте)
+CLEANUP_INTERVAL_SEC = int(os.getenv("CLEANUP_INTERVAL_SEC", "3600"))
+# как часто укорачивать WAL и освежать статистику планировщика (PRAGMA optimize)
+OPTIMIZE_INTERVAL_SEC = int(os.getenv("OPTIMIZE_INTERVAL_SEC", "900"))
+# очередь event/heartbeat перед пакетной записью в events
+EVENT_QUEUE_MAX = int(os.getenv("EVENT_QUEUE_MAX", "10000"))
+EVENT_BATCH_MAX = int(os.getenv("EVENT_BATCH_MAX", "500"))
+
+log = logging.getLogger("uvicorn.error")
+
+# JSON-ответы кодируем orjson — сразу в UTF-8 байты, без stdlib json
+app = FastAPI(title="antibot", default_response_class=ORJSONResponse)
+# сжимаем только то, что того стоит (antibot.js, списки админки): короткие ответы
+# /collect и /risk меньше порога и идут как есть. Уровень 6 — почти тот же размер,
+# что и 9, за заметно меньшее время.
+# GZip правит заголовки ответа на месте: общий (заранее собранный) Response с телом
+# через неё пускать нельзя — первый же gzip-клиент навсегда пометит его сжатым
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=6)
 
 STATIC_DIR = os.path.join(APP_DIR, "static")
 os.makedirs(STATIC_DIR, exist_ok=True)
@@ -35,16 +73,16 @@ def _ensure_antibot_js_present():
     root_js = os.path.join(APP_DIR, "antibot.js")
     static_js = os.path.join(STATIC_DIR, "antibot.js")
     if os.path.exists(root_js):
-        # обновляем static, если отличается
+        # обновляем static, если отличается: сверяем размер и mtime, а не содержимое.
+        # copy2 переносит и mtime, так что после копии следующий старт сюда уже не дойдёт
         try:
-            with open(root_js, "rb") as f1, open(static_js, "rb") as f2:
-                if f1.read() == f2.read():
-                    return
-        except Exception:
+            st_root, st_static = os.stat(root_js), os.stat(static_js)
+            if (st_root.st_size, st_root.st_mtime_ns) == (st_static.st_size, st_static.st_mtime_ns):
+                return
+        except OSError:
             pass
         try:
-            with open(root_js, "rb") as src, open(static_js, "wb") as dst:
-                dst.write(src.read())
+            shutil.copy2(root_js, static_js)
         except Exception:
             pass
 
@@ -56,150 +94,527 @@ def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def db() -> sqlite3.Connection:
-    con = sqlite3.connect(DB_PATH)
+# время в БД — INTEGER, секунды unix epoch (UTC); наружу в API отдаём ISO
+def now_ts() -> int:
+    return int(time.time())
+
+
+def ts_iso(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _finite(obj):
+    # NaN/Infinity — не JSON: их не примут json_patch и прочие JSON-функции SQLite.
+    # Заменяем на null, как это делает orjson
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _finite(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(v) for v in obj]
+    return obj
+
+
+def dumps(obj) -> str:
+    # orjson сразу отдаёт UTF-8 (как ensure_ascii=False), в разы быстрее stdlib json
+    try:
+        return orjson.dumps(obj).decode()
+    except TypeError:
+        # orjson не умеет целые шире 64 бит — такой редкий payload пишем штатным json,
+        # но тоже строгим JSON
+        return json.dumps(_finite(obj), ensure_ascii=False, allow_nan=False)
+
+
+# пул заранее открытых соединений для чтения: заполняется в startup и живёт до shutdown,
+# так SQLite держит кэш страниц тёплым и не платит за connect() на каждый запрос.
+# LIFO — чтобы чаще брать только что вернувшееся (самое «горячее») соединение.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+_DB_POOL: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_DB_CONS: List[sqlite3.Connection] = []
+
+# SQLite всё равно пускает только одного писателя — пишем через одно выделенное
+# соединение под своим мьютексом, читатели пула под WAL идут параллельно
+_DB_WRITER: Optional[sqlite3.Connection] = None
+_DB_WRITE_LOCK = threading.Lock()
+
+# кэш страниц (КиБ). Большой — только писателю: он один и живёт весь процесс.
+# Читателям пула — дефолт SQLite (~2 МиБ), иначе кэш умножится на DB_POOL_SIZE.
+# Итого по умолчанию: 64 МиБ + 16 x 2 МиБ ≈ 96 МиБ
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "65536"))
+DB_READ_CACHE_KB = int(os.getenv("DB_READ_CACHE_KB", "2000"))
+
+_DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=60000;
+PRAGMA wal_autocheckpoint=1000;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+"""
+
+
+def open_db(readonly: bool = False) -> sqlite3.Connection:
+    # кэш подготовленных выражений побольше дефолтных 100: SQL горячего пути
+    # не должен вытесняться разовыми запросами админки
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
     con.row_factory = sqlite3.Row
+    con.executescript(_DB_PRAGMAS)
+    con.execute(f"PRAGMA cache_size=-{DB_READ_CACHE_KB if readonly else DB_CACHE_KB}")
+    if readonly:
+        # случайная запись мимо write_tx упадёт сразу, а не будет бороться за блокировку
+        con.execute("PRAGMA query_only=1")
     return con
 
 
+@contextmanager
+def db():
+    """Соединение только для чтения из пула."""
+    if not _DB_CONS:
+        raise RuntimeError("database is not opened")
+    con = _DB_POOL.get()
+    try:
+        yield con
+    finally:
+        _DB_POOL.put(con)
+
+
+@contextmanager
+def db_writer():
+    """Пишущее соединение под мьютексом; транзакцией управляет вызывающий."""
+    if _DB_WRITER is None:
+        raise RuntimeError("database is not opened")
+    with _DB_WRITE_LOCK:
+        yield _DB_WRITER
+
+
+def open_pool():
+    global _DB_WRITER
+    # писатель первым: он переводит свежую БД в WAL, читателям это уже нельзя
+    _DB_WRITER = open_db()
+    for _ in range(DB_POOL_SIZE):
+        con = open_db(readonly=True)
+        _DB_CONS.append(con)
+        _DB_POOL.put(con)
+
+
+def close_pool():
+    global _DB_WRITER
+    while not _DB_POOL.empty():
+        _DB_POOL.get_nowait()
+    for con in _DB_CONS:
+        con.close()
+    _DB_CONS.clear()
+    if _DB_WRITER is not None:
+        with _DB_WRITE_LOCK:
+            # SQLite советует optimize и при закрытии соединения
+            _DB_WRITER.execute("PRAGMA optimize")
+            _DB_WRITER.close()
+            _DB_WRITER = None
+
+
+@contextmanager
+def write_tx():
+    """Одна транзакция на запрос: все записи уходят одним COMMIT (один fsync)."""
+    with db_writer() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+            con.execute("COMMIT")
+        except BaseException:
+            # соединение-писатель одно на процесс: нельзя оставить его внутри
+            # транзакции (упавший COMMIT), а после ошибок, на которых SQLite уже
+            # откатил сам, ROLLBACK только заглушил бы исходное исключение
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+
+
+# версия схемы в PRAGMA user_version — по ней делаем разовые миграции старых БД
+SCHEMA_VERSION = 5
+
+# колонки времени по таблицам: до v3 там лежал ISO-текст, с v3 — INTEGER epoch
+_TS_COLUMNS = {
+    "leads": ("ts",),
+    "events": ("ts",),
+    "visitors": ("first_ts", "last_ts"),
+    "blocked_phones": ("ts",),
+    "blocked_vids": ("ts",),
+    "alerts": ("ts",),
+}
+
+
 def init_db():
-    con = db()
-    cur = con.cursor()
+    with db_writer() as con:
+        cur = con.cursor()
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS leads (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ts TEXT NOT NULL,
-        site TEXT NOT NULL,
-        vid TEXT NOT NULL,
-        ip TEXT,
-        ua TEXT,
-        name TEXT,
-        phone TEXT,
-        email TEXT,
-        form_action TEXT,
-        form_id TEXT,
-        payload_json TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS events (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ts TEXT NOT NULL,
-        site TEXT NOT NULL,
-        vid TEXT NOT NULL,
-        ip TEXT,
-        ua TEXT,
-        path TEXT,
-        ref TEXT,
-        kind TEXT NOT NULL,
-        payload_json TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS visitors (
-        vid TEXT NOT NULL,
-        site TEXT NOT NULL,
-        first_ts TEXT NOT NULL,
-        last_ts TEXT NOT NULL,
-        last_ip TEXT,
-        last_ua TEXT,
-        last_path TEXT,
-        interaction_json TEXT,
-        last_score INTEGER NOT NULL DEFAULT 0,
-        last_reasons_json TEXT,
-        captcha_required INTEGER NOT NULL DEFAULT 0,
-        suspicious INTEGER NOT NULL DEFAULT 0,
-        blocked INTEGER NOT NULL DEFAULT 0,
-        lead_count INTEGER NOT NULL DEFAULT 0,
-        last_phone TEXT,
-        last_name TEXT,
-        PRIMARY KEY (vid, site)
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS blocked_phones (
-        phone TEXT PRIMARY KEY,
-        ts TEXT NOT NULL,
-        reason TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS blocked_vids (
-        vid TEXT PRIMARY KEY,
-        ts TEXT NOT NULL,
-        reason TEXT,
-        phone TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS alerts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ts TEXT NOT NULL,
-        site TEXT NOT NULL,
-        vid TEXT NOT NULL,
-        phone TEXT,
-        name TEXT,
-        score INTEGER NOT NULL,
-        reasons_json TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS captcha_challenges (
-        id TEXT PRIMARY KEY,
-        ts INTEGER NOT NULL,
-        vid TEXT NOT NULL,
-        site TEXT NOT NULL,
-        question TEXT NOT NULL,
-        answer TEXT NOT NULL
-    )
-    """)
-
-    con.commit()
-    con.close()
+        version = int(cur.execute("PRAGMA user_version").fetchone()[0])
+        existing = {r["name"] for r in cur.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        cur.execute("BEGIN")
+
+        # v1: блок-листы стали WITHOUT ROWID; v3: время хранится INTEGER-секундами.
+        # Оба перехода — пересборка: старые таблицы отодвигаем (вместе с их индексами,
+        # иначе CREATE INDEX IF NOT EXISTS ниже их «найдёт»), ниже создадутся новые
+        # и данные перельются
+        moved = []
+        if version < 3:
+            for t in _TS_COLUMNS:
+                if t in existing:
+                    cur.execute(f"ALTER TABLE {t} RENAME TO {t}_v0")
+                    idx = [r["name"] for r in cur.execute(
+                        "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (f"{t}_v0",))]
+                    for i in idx:
+                        cur.execute(f"DROP INDEX {i}")
+                    moved.append(t)
+
+        # v2: капча больше не хранится в БД (см. captcha_verify)
+        if version < 2:
+            cur.execute("DROP TABLE IF EXISTS captcha_challenges")
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS leads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            site TEXT NOT NULL,
+            vid TEXT NOT NULL,
+            ip TEXT,
+            ua TEXT,
+            name TEXT,
+            phone TEXT,
+            email TEXT,
+            form_action TEXT,
+            form_id TEXT,
+            payload_json TEXT
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            site TEXT NOT NULL,
+            vid TEXT NOT NULL,
+            ip TEXT,
+            ua TEXT,
+            path TEXT,
+            ref TEXT,
+            kind TEXT NOT NULL,
+            payload_json TEXT
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS visitors (
+            vid TEXT NOT NULL,
+            site TEXT NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            last_ip TEXT,
+            last_ua TEXT,
+            last_path TEXT,
+            interaction_json TEXT,
+            last_score INTEGER NOT NULL DEFAULT 0,
+            last_reasons_json TEXT,
+            captcha_required INTEGER NOT NULL DEFAULT 0,
+            suspicious INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            lead_count INTEGER NOT NULL DEFAULT 0,
+            last_phone TEXT,
+            last_name TEXT,
+            PRIMARY KEY (vid, site)
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS blocked_phones (
+            phone TEXT PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            reason TEXT
+        ) WITHOUT ROWID
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS blocked_vids (
+            vid TEXT PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            reason TEXT,
+            phone TEXT
+        ) WITHOUT ROWID
+        """)
+
+        # различные телефоны/имена визитора — по строке на значение. Счётчики для
+        # скоринга берутся отсюда точечным чтением, а не DISTINCT по всем его лидам
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS visitor_values (
+            site TEXT NOT NULL,
+            vid TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (site, vid, kind, value)
+        ) WITHOUT ROWID
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER NOT NULL,
+            site TEXT NOT NULL,
+            vid TEXT NOT NULL,
+            phone TEXT,
+            name TEXT,
+            score INTEGER NOT NULL,
+            reasons_json TEXT
+        )
+        """)
+
+        for t in moved:
+            cols = [r["name"] for r in cur.execute(f"PRAGMA table_info({t}_v0)")]
+            exprs = [
+                f"COALESCE(CAST(strftime('%s', {c}) AS INTEGER), 0)" if c in _TS_COLUMNS[t] else c
+                for c in cols
+            ]
+            cur.execute(f"INSERT INTO {t} ({', '.join(cols)}) SELECT {', '.join(exprs)} FROM {t}_v0")
+            cur.execute(f"DROP TABLE {t}_v0")
+
+        # v4: visitor_values заполняем из уже накопленных лидов
+        if version < 4:
+            cur.execute("""
+                INSERT OR IGNORE INTO visitor_values (site, vid, kind, value)
+                SELECT site, vid, 'phone', COALESCE(phone, '') FROM leads
+                UNION ALL
+                SELECT site, vid, 'name', COALESCE(name, '') FROM leads
+            """)
+
+        # индексы — после переливки данных: построить индекс по готовой таблице
+        # дешевле, чем обновлять его на каждую вставленную строку.
+        # Под lead_history_stats: счётчики по vid и по телефону считаются прямо
+        # по B-дереву индекса, без чтения строк leads.
+        # v4: phone/name из idx_leads_site_vid ушли — DISTINCT по ним больше не считаем
+        if version < 4:
+            cur.execute("DROP INDEX IF EXISTS idx_leads_site_vid")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_site_vid ON leads (site, vid)")
+        # v5: индексы по телефону частичные — лиды без телефона в них не попадают,
+        # а запросы всегда ищут конкретный телефон (phone=? сам подразумевает NOT NULL)
+        if version < 5:
+            cur.execute("DROP INDEX IF EXISTS idx_leads_site_phone")
+            cur.execute("DROP INDEX IF EXISTS idx_leads_phone")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_site_phone ON leads (site, phone) WHERE phone IS NOT NULL")
+        # админские выборки по телефону без site (блокировка, lookup) и чистка событий по ts
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_leads_phone ON leads (phone) WHERE phone IS NOT NULL")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts)")
+
+        cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        con.commit()
+        # чтобы планировщик сразу подхватил новые индексы: после миграции — полная
+        # статистика (с ограничением на число строк на индекс), иначе — optimize
+        if version < SCHEMA_VERSION:
+            cur.execute("PRAGMA analysis_limit=1000")
+            cur.execute("ANALYZE")
+        else:
+            cur.execute("PRAGMA optimize")
+
+
+CLEANUP_CHUNK = 1000
+
+
+def _delete_chunked(table: str, cutoff: int) -> int:
+    # порциями, каждая в своей короткой транзакции: между ними /collect
+    # и писатель событий успевают взять блокировку записи
+    deleted = 0
+    while True:
+        with write_tx() as con:
+            cur = con.execute(
+                f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE ts < ? LIMIT ?)",
+                (cutoff, CLEANUP_CHUNK),
+            )
+        deleted += cur.rowcount
+        if cur.rowcount < CLEANUP_CHUNK:
+            return deleted
 
 
 def cleanup_db():
-    """Удаляем старые события и старые капчи."""
-    con = db()
-    cur = con.cursor()
+    """Удаляем старые события и алерты."""
+    now = now_ts()
+    _delete_chunked("events", now - EVENTS_TTL_DAYS * 86400)
+    if ALERTS_TTL_DAYS > 0:
+        _delete_chunked("alerts", now - ALERTS_TTL_DAYS * 86400)
+
 
-    cutoff = datetime.now(timezone.utc) - timedelta(days=EVENTS_TTL_DAYS)
-    cur.execute("DELETE FROM events WHERE ts < ?", (cutoff.isoformat(),))
+async def _cleanup_loop():
+    # первый проход сразу после старта, но уже в фоне — старт его не ждёт
+    while True:
+        try:
+            # DELETE блокирующий — гоняем в потоке, чтобы не стопорить event loop
+            await asyncio.to_thread(cleanup_db)
+        except Exception:
+            log.exception("periodic cleanup failed")
+        await asyncio.sleep(CLEANUP_INTERVAL_SEC)
 
-    cutoff_captcha = int(time.time()) - CAPTCHA_TTL_SEC
-    cur.execute("DELETE FROM captcha_challenges WHERE ts < ?", (cutoff_captcha,))
 
-    con.commit()
-    con.close()
+def maintain_db():
+    # под мьютексом писателя: checkpoint не конкурирует с нашими же транзакциями,
+    # а optimize может запустить ANALYZE, а это запись
+    with db_writer() as con:
+        # автоматический checkpoint только переносит страницы, но файл WAL не укорачивает —
+        # после пика записи он так и остался бы большим
+        con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        con.execute("PRAGMA optimize")
+
+
+async def _maintenance_loop():
+    while True:
+        await asyncio.sleep(OPTIMIZE_INTERVAL_SEC)
+        try:
+            await asyncio.to_thread(maintain_db)
+        except Exception:
+            log.exception("periodic db maintenance failed")
+
+
+# event/heartbeat не влияют на ответ /collect — и визитор, и строка events для них
+# копятся в очереди, а отдельный поток пишет их пачками (group commit): два
+# executemany и один COMMIT на пачку. Поток, а не asyncio-задача: /collect работает
+# в тредпуле, и при остановке поток должен успеть дописать очередь.
+# Из очереди берут только под write_tx — так лид визитора (см. collect_write)
+# забирает его ещё не записанные heartbeat'ы строго до своей записи.
+_EVENT_PENDING: List[tuple] = []  # (параметры upsert визитора, параметры INSERT в events)
+_EVENT_PENDING_LOCK = threading.Lock()
+_EVENT_READY = threading.Event()
+_EVENT_WRITER_STOP = threading.Event()
+_EVENT_WRITER: Optional[threading.Thread] = None
+
+
+def queue_event(item: tuple) -> bool:
+    """False — очередь полна, писать надо самому."""
+    with _EVENT_PENDING_LOCK:
+        if len(_EVENT_PENDING) >= EVENT_QUEUE_MAX:
+            return False
+        _EVENT_PENDING.append(item)
+    _EVENT_READY.set()
+    return True
+
+
+def take_events(site: Optional[str] = None, vid: Optional[str] = None) -> List[tuple]:
+    """Забирает из очереди пачку (или всё по одному визитору). Только под write_tx."""
+    with _EVENT_PENDING_LOCK:
+        if vid is None:
+            batch = _EVENT_PENDING[:EVENT_BATCH_MAX]
+            del _EVENT_PENDING[:EVENT_BATCH_MAX]
+        else:
+            batch = [e for e in _EVENT_PENDING if e[0][0] == vid and e[0][1] == site]
+            if batch:
+                _EVENT_PENDING[:] = [e for e in _EVENT_PENDING if not (e[0][0] == vid and e[0][1] == site)]
+        if not _EVENT_PENDING:
+            _EVENT_READY.clear()
+    return batch
+
+
+def _write_events_rows(con, batch: List[tuple]):
+    con.executemany(_SQL_TOUCH_VISITOR, [v for v, _ in batch])
+    con.executemany(_SQL_INSERT_EVENT, [e for _, e in batch])
+
+
+def write_events(con, batch: List[tuple]):
+    if not batch:
+        return
+    # пачка целиком под SAVEPOINT: одна битая строка не должна утянуть за собой
+    # события остальных визиторов — при ошибке пишем по одной и выкидываем только битые
+    con.execute("SAVEPOINT events_batch")
+    try:
+        _write_events_rows(con, batch)
+    except sqlite3.Error:
+        con.execute("ROLLBACK TO events_batch")
+        for item in batch:
+            con.execute("SAVEPOINT events_row")
+            try:
+                _write_events_rows(con, [item])
+            except sqlite3.Error as e:
+                con.execute("ROLLBACK TO events_row")
+                (vid, site, *_), _ = item
+                log.warning("event row dropped: site=%s vid=%s: %s", site, vid, e)
+            con.execute("RELEASE events_row")
+    con.execute("RELEASE events_batch")
+
+
+def _event_writer():
+    while True:
+        _EVENT_READY.wait(0.1)
+        with _EVENT_PENDING_LOCK:
+            idle = not _EVENT_PENDING
+        if idle:
+            if _EVENT_WRITER_STOP.is_set():
+                return
+            continue
+        batch = []
+        try:
+            with write_tx() as con:
+                batch = take_events()
+                write_events(con, batch)
+        except Exception:
+            log.exception("events batch insert failed, %d rows lost", len(batch))
+            continue
+        for (vid, site, *_), _ in batch:
+            visitor_cache_drop(site, vid)
+
+
+def start_event_writer():
+    global _EVENT_WRITER
+    _EVENT_WRITER_STOP.clear()
+    _EVENT_WRITER = threading.Thread(target=_event_writer, name="event-writer", daemon=True)
+    _EVENT_WRITER.start()
+
+
+def stop_event_writer():
+    """Дописывает очередь до конца и останавливает поток."""
+    global _EVENT_WRITER
+    if _EVENT_WRITER is None:
+        return
+    _EVENT_WRITER_STOP.set()
+    _EVENT_WRITER.join()
+    _EVENT_WRITER = None
+
+
+_BG_TASKS: List[asyncio.Task] = []
 
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    open_pool()
     init_db()
-    cleanup_db()
+    load_blocklists()
+    start_event_writer()
+    _BG_TASKS.append(asyncio.create_task(_cleanup_loop()))
+    _BG_TASKS.append(asyncio.create_task(_maintenance_loop()))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for t in _BG_TASKS:
+        t.cancel()
+    await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+    _BG_TASKS.clear()
+    await asyncio.to_thread(stop_event_writer)
+    close_pool()
 
 
 def require_admin(x_admin_token: Optional[str]):
     if not ADMIN_TOKEN:
         raise HTTPException(status_code=500, detail="ADMIN_TOKEN is not set on server")
-    if not x_admin_token or x_admin_token != ADMIN_TOKEN:
+    # сравнение за постоянное время — по времени ответа не подобрать токен побайтно
+    cand = hashlib.sha256((x_admin_token or "").encode()).digest()
+    if not x_admin_token or not hmac.compare_digest(cand, _ADMIN_TOKEN_DIGEST):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+# всё, кроме цифр и плюса — фильтр идёт в C, без цикла по символам в Python
+_PHONE_JUNK = re.compile(r"[^\d+]+")
+
+
 def norm_phone(p: Optional[str]) -> Optional[str]:
     if not p:
         return None
-    s = "".join(ch for ch in p if ch.isdigit() or ch == "+")
+    s = _PHONE_JUNK.sub("", p)
     s = s.replace("++", "+")
-    digits = "".join(ch for ch in s if ch.isdigit())
+    digits = s.replace("+", "")
     # RU нормализация (простая)
     if digits.startswith("8") and len(digits) == 11:
         return "+7" + digits[1:]
@@ -212,80 +627,173 @@ def norm_phone(p: Optional[str]) -> Optional[str]:
     return s
 
 
+# SQL горячего пути /collect и /risk — строки на уровне модуля, чтобы кэш
+# подготовленных выражений sqlite3 гарантированно попадал
+_SQL_GET_VISITOR = "SELECT * FROM visitors WHERE site=? AND vid=?"
+
+# новый визитор или обновление существующего — одним UPSERT, без SELECT перед ним.
+# interaction сливается прямо в SQLite (json_patch, RFC 7396): присланные ключи
+# перезаписываются, остальные остаются; битый/пустой JSON в строке считаем {}
+_SQL_UPSERT_VISITOR = """
+    INSERT INTO visitors (vid, site, first_ts, last_ts, last_ip, last_ua, last_path, interaction_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (vid, site) DO UPDATE SET
+        last_ts=excluded.last_ts,
+        last_ip=excluded.last_ip,
+        last_ua=excluded.last_ua,
+        last_path=excluded.last_path,
+        interaction_json=json_patch(CASE WHEN json_valid(interaction_json) THEN interaction_json ELSE '{}' END,
+                                    excluded.interaction_json)
+    RETURNING *
+"""
+
+# то же без RETURNING — для пачек из очереди событий (executemany строк не возвращает)
+_SQL_TOUCH_VISITOR = _SQL_UPSERT_VISITOR.replace("RETURNING *", "")
+
+_SQL_SCORE_VISITOR = """
+    UPDATE visitors
+    SET lead_count = lead_count + 1,
+        last_phone=?,
+        last_name=?,
+        last_score=?,
+        last_reasons_json=?,
+        captcha_required=?,
+        suspicious=?,
+        blocked=?
+    WHERE site=? AND vid=?
+"""
+
+_SQL_INSERT_EVENT = """
+    INSERT INTO events (ts, site, vid, ip, ua, path, ref, kind, payload_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_LEAD = """
+    INSERT INTO leads (ts, site, vid, ip, ua, name, phone, email, form_action, form_id, payload_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# телефон и имя лида в сводку визитора (пустое значение тоже считается, как раньше)
+_SQL_ADD_VISITOR_VALUES = """
+    INSERT OR IGNORE INTO visitor_values (site, vid, kind, value)
+    VALUES (:site, :vid, 'phone', :phone), (:site, :vid, 'name', :name)
+"""
+
+# все счётчики одним запросом: лиды по vid и по телефону — по индексам leads,
+# различные телефоны/имена — по сводке visitor_values (телефон мог светиться и у других vid)
+_SQL_LEAD_HISTORY = """
+    SELECT (SELECT COUNT(*) FROM leads WHERE site=:site AND vid=:vid) AS vid_count,
+           (SELECT COUNT(*) FROM visitor_values WHERE site=:site AND vid=:vid AND kind='phone') AS distinct_phones,
+           (SELECT COUNT(*) FROM visitor_values WHERE site=:site AND vid=:vid AND kind='name') AS distinct_names,
+           (SELECT COUNT(*) FROM leads WHERE site=:site AND phone=:phone) AS phone_count
+"""
+
+_SQL_INSERT_ALERT = """
+    INSERT INTO alerts (ts, site, vid, phone, name, score, reasons_json)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
 def get_visitor(con, site: str, vid: str) -> Optional[sqlite3.Row]:
     cur = con.cursor()
-    cur.execute("SELECT * FROM visitors WHERE site=? AND vid=?", (site, vid))
+    cur.execute(_SQL_GET_VISITOR, (site, vid))
     return cur.fetchone()
 
 
-def upsert_visitor(con, site: str, vid: str, ip: str, ua: str, path: Optional[str], interaction: Optional[dict] = None):
-    cur = con.cursor()
-    existing = get_visitor(con, site, vid)
-    ts = now_iso()
-    if existing is None:
-        cur.execute("""
-            INSERT INTO visitors (vid, site, first_ts, last_ts, last_ip, last_ua, last_path, interaction_json)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (vid, site, ts, ts, ip, ua, path, json.dumps(interaction or {})))
-    else:
-        # merge interaction
-        old = {}
-        try:
-            old = json.loads(existing["interaction_json"] or "{}")
-        except Exception:
-            old = {}
-        newi = old
-        if interaction:
-            # обновим только известные поля
-            for k, v in interaction.items():
-                newi[k] = v
-        cur.execute("""
-            UPDATE visitors
-            SET last_ts=?, last_ip=?, last_ua=?, last_path=?, interaction_json=?
-            WHERE site=? AND vid=?
-        """, (ts, ip, ua, path, json.dumps(newi), site, vid))
+# /risk дёргается на каждом показе страницы — держим его данные по визитору
+# несколько секунд в памяти. Запись в /collect сбрасывает ключ после COMMIT,
+# так что TTL страхует только от гонки «прочитали старое — положили после сброса».
+VISITOR_CACHE_TTL_SEC = float(os.getenv("VISITOR_CACHE_TTL_SEC", "5"))
+_VISITOR_CACHE_MAX = 10_000
+_VISITOR_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_VISITOR_CACHE_LOCK = threading.Lock()
+_CACHE_MISS = object()
 
 
-def is_blocked(con, vid: str, phone: Optional[str]) -> bool:
-    cur = con.cursor()
-    cur.execute("SELECT 1 FROM blocked_vids WHERE vid=? LIMIT 1", (vid,))
-    if cur.fetchone():
-        return True
-    if phone:
-        cur.execute("SELECT 1 FROM blocked_phones WHERE phone=? LIMIT 1", (phone,))
-        if cur.fetchone():
-            return True
-    return False
+def visitor_cache_get(site: str, vid: str):
+    with _VISITOR_CACHE_LOCK:
+        hit = _VISITOR_CACHE.get((site, vid))
+    if hit is None or hit[0] < time.monotonic():
+        return _CACHE_MISS
+    return hit[1]
 
 
-def lead_history_stats(con, site: str, vid: str, phone: Optional[str]) -> dict:
+def visitor_cache_put(site: str, vid: str, value):
+    key = (site, vid)
+    with _VISITOR_CACHE_LOCK:
+        _VISITOR_CACHE[key] = (time.monotonic() + VISITOR_CACHE_TTL_SEC, value)
+        _VISITOR_CACHE.move_to_end(key)
+        if len(_VISITOR_CACHE) > _VISITOR_CACHE_MAX:
+            _VISITOR_CACHE.popitem(last=False)
+
+
+def visitor_cache_drop(site: str, vid: str):
+    with _VISITOR_CACHE_LOCK:
+        _VISITOR_CACHE.pop((site, vid), None)
+
+
+def upsert_visitor(con, ts: int, site: str, vid: str, ip: str, ua: str, path: Optional[str], interaction: Optional[dict] = None) -> sqlite3.Row:
+    """Пишет визитора и возвращает его строку уже после записи (RETURNING — без повторного SELECT)."""
     cur = con.cursor()
+    cur.execute(_SQL_UPSERT_VISITOR, (vid, site, ts, ts, ip, ua, path, dumps(interaction or {})))
+    return cur.fetchone()
 
-    # для текущего VID
-    cur.execute("SELECT COUNT(*) as c FROM leads WHERE site=? AND vid=?", (site, vid))
-    vid_count = int(cur.fetchone()["c"])
 
-    cur.execute("SELECT COUNT(DISTINCT COALESCE(phone,'')) as c FROM leads WHERE site=? AND vid=?", (site, vid))
-    distinct_phones = int(cur.fetchone()["c"])
+# блок-листы целиком в памяти: на горячем пути проверка — это поиск в set, без SQL.
+# Грузятся в startup и меняются только через /admin/* этого же процесса
+# (сервис работает одним процессом uvicorn); add/discard у set атомарны под GIL.
+_BLOCKED_VIDS: Set[str] = set()
+_BLOCKED_PHONES: Set[str] = set()
 
-    cur.execute("SELECT COUNT(DISTINCT COALESCE(name,'')) as c FROM leads WHERE site=? AND vid=?", (site, vid))
-    distinct_names = int(cur.fetchone()["c"])
 
-    # для телефона (если есть)
-    phone_count = 0
-    if phone:
-        cur.execute("SELECT COUNT(*) as c FROM leads WHERE site=? AND phone=?", (site, phone))
-        phone_count = int(cur.fetchone()["c"])
+def load_blocklists():
+    with db() as con:
+        vids = {r["vid"] for r in con.execute("SELECT vid FROM blocked_vids")}
+        phones = {r["phone"] for r in con.execute("SELECT phone FROM blocked_phones")}
+    _BLOCKED_VIDS.clear()
+    _BLOCKED_VIDS.update(vids)
+    _BLOCKED_PHONES.clear()
+    _BLOCKED_PHONES.update(phones)
+
+
+def is_blocked(vid: str, phone: Optional[str]) -> bool:
+    return vid in _BLOCKED_VIDS or (bool(phone) and phone in _BLOCKED_PHONES)
+
+
+def lead_history_stats(con, site: str, vid: str, phone: Optional[str]) -> dict:
+    cur = con.cursor()
+    cur.execute(_SQL_LEAD_HISTORY, {"site": site, "vid": vid, "phone": phone or None})
+    row = cur.fetchone()
 
     return {
-        "vid_count": vid_count,
-        "distinct_phones": distinct_phones,
-        "distinct_names": distinct_names,
-        "phone_count": phone_count,
+        "vid_count": int(row["vid_count"]),
+        "distinct_phones": int(row["distinct_phones"]),
+        "distinct_names": int(row["distinct_names"]),
+        "phone_count": int(row["phone_count"]),
     }
 
 
-def score_suspicion(site: str, vid: str, interaction: dict, history: dict, lead: Optional[dict]) -> (int, List[str], bool, bool):
+class Interaction(BaseModel):
+    """Поведенческие счётчики со страницы. Остальные поля от клиента сохраняем как есть."""
+    model_config = ConfigDict(extra="allow")
+
+    duration_ms: int = 0
+    mouse_moves: int = 0
+    scrolls: int = 0
+    keydowns: int = 0
+
+    @field_validator("duration_ms", "mouse_moves", "scrolls", "keydowns", mode="before")
+    @classmethod
+    def _as_int(cls, v):
+        # как раньше int(x or 0): null -> 0, дробные обрезаем;
+        # мусор (строки, списки, объекты, 1e400) не валит запрос, а считается нулём
+        try:
+            return int(v or 0)
+        except (TypeError, ValueError, OverflowError):
+            return 0
+
+
+def score_suspicion(site: str, vid: str, interaction: Interaction, history: dict, lead: Optional[dict]) -> (int, List[str], bool, bool):
     """
     Возвращает: score, reasons[], captcha_required, suspicious_alert
     """
@@ -293,10 +801,10 @@ def score_suspicion(site: str, vid: str, interaction: dict, history: dict, lead:
     reasons = []
 
     # 1) поведение на странице (минимальный интерактив + слишком быстро)
-    dur = int(interaction.get("duration_ms") or 0)
-    moves = int(interaction.get("mouse_moves") or 0)
-    scrolls = int(interaction.get("scrolls") or 0)
-    keys = int(interaction.get("keydowns") or 0)
+    dur = interaction.duration_ms
+    moves = interaction.mouse_moves
+    scrolls = interaction.scrolls
+    keys = interaction.keydowns
 
     if dur and dur < 4000:
         score += 25
@@ -338,35 +846,39 @@ def score_suspicion(site: str, vid: str, interaction: dict, history: dict, lead:
     return score, reasons, captcha_required, suspicious_alert
 
 
-def create_alert(con, site: str, vid: str, phone: Optional[str], name: Optional[str], score: int, reasons: List[str]):
+def create_alert(con, ts: int, site: str, vid: str, phone: Optional[str], name: Optional[str], score: int, reasons: List[str]):
     cur = con.cursor()
-    cur.execute("""
-        INSERT INTO alerts (ts, site, vid, phone, name, score, reasons_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (now_iso(), site, vid, phone, name, score, json.dumps(reasons, ensure_ascii=False)))
-    con.commit()
+    cur.execute(_SQL_INSERT_ALERT, (ts, site, vid, phone, name, score, dumps(reasons)))
 
 
 class CollectIn(BaseModel):
+    # запрос только читаем; лишние поля от клиента молча отбрасываем
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     site: str
     vid: str
     path: Optional[str] = None
     ref: Optional[str] = None
     kind: str = Field(..., description="event|lead|heartbeat")
-    interaction: Optional[Dict[str, Any]] = None
+    interaction: Optional[Interaction] = None
     lead: Optional[Dict[str, Any]] = None
     captcha: Optional[Dict[str, Any]] = None
 
+    @field_validator("site", "vid")
+    @classmethod
+    def _clip_id(cls, v: str) -> str:
+        # обрезка один раз при разборе, пустое значение ловит /collect (400, как раньше)
+        return v.strip()[:200]
+
 
 @app.get("/health")
 def health():
     return {"ok": True, "ts": now_iso()}
 
 
-@app.get("/bridge", response_class=HTMLResponse)
-def bridge():
-    # простая страница-бридж (если нужно iFrame/bridge на сайт)
-    return HTMLResponse("""<!doctype html><html><head><meta charset="utf-8"></head><body>
+# простая страница-бридж (если нужно iFrame/bridge на сайт); она константная,
+# поэтому ответ собираем один раз при импорте и отдаём один и тот же объект
+_BRIDGE_HTML = """<!doctype html><html><head><meta charset="utf-8"></head><body>
 <script>
 (function(){
   var KEY="svf_global_vid";
@@ -381,47 +893,125 @@ def bridge():
     }
   });
 })();
-</script></body></html>""")
+</script></body></html>"""
+_BRIDGE_BYTES = _BRIDGE_HTML.encode()
+_BRIDGE_ETAG = '"%s"' % hashlib.blake2b(_BRIDGE_BYTES, digest_size=16).hexdigest()
+_BRIDGE_HEADERS = {"ETag": _BRIDGE_ETAG, "Cache-Control": "public, max-age=86400"}
+# 304 без тела GZip не трогает — его можно держать готовым
+_BRIDGE_NOT_MODIFIED = Response(status_code=304, headers=_BRIDGE_HEADERS)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # ETag у antibot.js слабый (W/): GZipMiddleware отдаёт то же тело то сжатым, то нет,
+    # байты разные — поэтому и сравнение слабое, без префикса W/ с обеих сторон
+    inm = request.headers.get("if-none-match")
+    etag = etag.removeprefix("W/")
+    return bool(inm) and (inm.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in inm.split(",")))
+
+
+@app.get("/bridge", response_class=HTMLResponse)
+def bridge(request: Request):
+    # iframe грузится на каждой странице — браузер держит его сутки, потом сверяет ETag
+    if etag_matches(request, _BRIDGE_ETAG):
+        return _BRIDGE_NOT_MODIFIED
+    # ответ с телом — каждый раз новый объект: GZip правит его заголовки на месте
+    return Response(_BRIDGE_BYTES, media_type="text/html; charset=utf-8", headers=_BRIDGE_HEADERS)
+
+
+# antibot.js грузится на каждом показе страницы — держим байты в памяти.
+# static смонтирован томом и файл правят без рестарта, поэтому на запрос
+# остаётся один stat: изменились размер/mtime — перечитываем.
+ANTIBOT_JS_MAX_AGE = int(os.getenv("ANTIBOT_JS_MAX_AGE", "3600"))
+_ANTIBOT_JS = None  # (size, mtime_ns), bytes, etag
+
+
+def _antibot_js_cached(js_path: str):
+    global _ANTIBOT_JS
+    try:
+        st = os.stat(js_path)
+    except FileNotFoundError:
+        return None
+    key = (st.st_size, st.st_mtime_ns)
+    cached = _ANTIBOT_JS
+    if cached is None or cached[0] != key:
+        with open(js_path, "rb") as f:
+            body = f.read()
+        cached = _ANTIBOT_JS = (key, body, 'W/"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest())
+    return cached
 
 
 @app.get("/antibot.js", response_class=PlainTextResponse)
-def antibot_js():
+def antibot_js(request: Request):
     # отдаём JS из static
-    js_path = os.path.join(STATIC_DIR, "antibot.js")
-    if not os.path.exists(js_path):
+    js = _antibot_js_cached(os.path.join(STATIC_DIR, "antibot.js"))
+    if js is None:
         raise HTTPException(status_code=404, detail="antibot.js not found on server")
-    with open(js_path, "r", encoding="utf-8") as f:
-        return PlainTextResponse(f.read(), media_type="application/javascript")
+    _, body, etag = js
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={ANTIBOT_JS_MAX_AGE}"}
+    if etag_matches(request, etag):
+        # 200 получает Vary от GZipMiddleware, 304 идёт мимо неё — ставим сами
+        return Response(status_code=304, headers={**headers, "Vary": "Accept-Encoding"})
+    return Response(body, media_type="application/javascript", headers=headers)
 
 
 @app.post("/collect")
-async def collect(payload: CollectIn, request: Request):
-    con = db()
+async def collect(request: Request):
+    # тело разбираем сами: pydantic-core читает JSON из байтов и валидирует за один
+    # проход, без промежуточного dict от request.json(); ошибки — тот же 422
     try:
-        ip = request.client.host if request.client else None
-        ua = request.headers.get("user-agent", "")
-
-        site = (payload.site or "").strip()[:200]
-        vid = (payload.vid or "").strip()[:200]
-        if not site or not vid:
-            raise HTTPException(status_code=400, detail="site and vid are required")
+        payload = CollectIn.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
+    ip = request.client.host if request.client else None
+    ua = request.headers.get("user-agent", "")
+    # запись в SQLite блокирующая — в тредпул, event loop её не ждёт
+    return await run_in_threadpool(collect_write, payload, ip, ua)
+
+
+def collect_write(payload: CollectIn, ip: Optional[str], ua: str) -> dict:
+    # одно время на весь запрос: визитор, событие, лид и алерт получают одинаковый ts
+    ts = now_ts()
+    site = payload.site
+    vid = payload.vid
+    if not site or not vid:
+        raise HTTPException(status_code=400, detail="site and vid are required")
+
+    # только реально присланные поля — иначе дефолтные нули затрут накопленное
+    interaction_in = payload.interaction.model_dump(exclude_unset=True) if payload.interaction else None
+
+    # event/heartbeat — визитора и событие пишет фоновый писатель, ответ его не ждёт
+    if payload.kind in ("event", "heartbeat"):
+        item = (
+            (vid, site, ts, ts, ip or "", ua or "", payload.path, dumps(interaction_in or {})),
+            (ts, site, vid, ip, ua, payload.path, payload.ref, payload.kind, dumps({
+                "interaction": interaction_in,
+                "extra": payload.lead  # на всякий
+            })),
+        )
+        if queue_event(item):
+            return {"ok": True}
+
+    with write_tx() as con:
+        # сперва ещё не записанные события этого визитора — иначе старый heartbeat
+        # лёг бы поверх свежего interaction уже после нас
+        pending = take_events(site, vid)
+        if pending:
+            write_events(con, pending)
+            # из очереди они уже вынуты: фиксируем сразу, чтобы 403/500 по лиду
+            # не откатил их вместе с собой. Писатель всё ещё наш — никто не вклинится
+            con.execute("COMMIT")
+            visitor_cache_drop(site, vid)
+            con.execute("BEGIN IMMEDIATE")
 
-        # обновляем визитора
-        upsert_visitor(con, site, vid, ip or "", ua or "", payload.path, payload.interaction or {})
+        if payload.kind in ("event", "heartbeat"):
+            # очередь полна — пишем сами в этой транзакции, но не теряем
+            write_events(con, [item])
+        else:
+            # обновляем визитора
+            vrow = upsert_visitor(con, ts, site, vid, ip or "", ua or "", payload.path, interaction_in or {})
 
         cur = con.cursor()
 
-        # пишем event/heartbeat
-        if payload.kind in ("event", "heartbeat"):
-            cur.execute("""
-                INSERT INTO events (ts, site, vid, ip, ua, path, ref, kind, payload_json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (now_iso(), site, vid, ip, ua, payload.path, payload.ref, payload.kind, json.dumps({
-                "interaction": payload.interaction,
-                "extra": payload.lead  # на всякий
-            }, ensure_ascii=False)))
-            con.commit()
-
         # лид
         if payload.kind == "lead":
             lead = payload.lead or {}
@@ -433,8 +1023,7 @@ async def collect(payload: CollectIn, request: Request):
 
             # если нужна капча — проверяем
             captcha_ok = True
-            vrow = get_visitor(con, site, vid)
-            need_captcha = int(vrow["captcha_required"]) == 1 if vrow else False
+            need_captcha = int(vrow["captcha_required"]) == 1
 
             if need_captcha:
                 captcha_ok = False
@@ -442,151 +1031,187 @@ async def collect(payload: CollectIn, request: Request):
                 cid = (cap.get("id") or "").strip()
                 ans = (cap.get("answer") or "").strip()
                 if cid and ans:
-                    cur.execute("SELECT * FROM captcha_challenges WHERE id=? LIMIT 1", (cid,))
-                    ch = cur.fetchone()
-                    if ch:
-                        # проверка TTL
-                        if int(time.time()) - int(ch["ts"]) <= CAPTCHA_TTL_SEC:
-                            if ch["vid"] == vid and ch["site"] == site and (ch["answer"].strip() == ans.strip()):
-                                captcha_ok = True
+                    captcha_ok = captcha_verify(cid, vid, site, ans)
 
             if need_captcha and not captcha_ok:
                 raise HTTPException(status_code=403, detail="captcha_required")
 
-            cur.execute("""
-                INSERT INTO leads (ts, site, vid, ip, ua, name, phone, email, form_action, form_id, payload_json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (now_iso(), site, vid, ip, ua, name, phone, email, form_action, form_id, json.dumps(lead, ensure_ascii=False)))
-            con.commit()
+            cur.execute(_SQL_INSERT_LEAD, (ts, site, vid, ip, ua, name, phone, email, form_action, form_id, dumps(lead)))
+            cur.execute(_SQL_ADD_VISITOR_VALUES, {"site": site, "vid": vid, "phone": phone or "", "name": name or ""})
 
-            # обновим счётчик лидов визитора
-            cur.execute("""
-                UPDATE visitors
-                SET lead_count = lead_count + 1,
-                    last_phone=?,
-                    last_name=?
-                WHERE site=? AND vid=?
-            """, (phone, name, site, vid))
-            con.commit()
-
-            # пересчёт риска после лида
-            vrow = get_visitor(con, site, vid)
-            interaction = {}
+            # пересчёт риска после лида; interaction уже слит в vrow (RETURNING из upsert_visitor),
+            # вставка лида строку визитора не трогает — перечитывать её незачем
             try:
-                interaction = json.loads(vrow["interaction_json"] or "{}") if vrow else {}
-            except Exception:
-                interaction = {}
+                interaction = Interaction.model_validate_json(vrow["interaction_json"] or "{}")
+            except ValidationError:
+                interaction = Interaction()
 
             history = lead_history_stats(con, site, vid, phone)
             score, reasons, cap_req, susp = score_suspicion(site, vid, interaction, history, {"name": name, "phone": phone, "email": email})
 
-            blocked = is_blocked(con, vid, phone)
+            blocked = is_blocked(vid, phone)
 
-            cur.execute("""
-                UPDATE visitors
-                SET last_score=?,
-                    last_reasons_json=?,
-                    captcha_required=?,
-                    suspicious=?,
-                    blocked=?
-                WHERE site=? AND vid=?
-            """, (score, json.dumps(reasons, ensure_ascii=False), int(cap_req), int(susp), int(blocked), site, vid))
-            con.commit()
+            # счётчик лидов и новый риск визитора — одним UPDATE
+            cur.execute(_SQL_SCORE_VISITOR, (phone, name, score, dumps(reasons), int(cap_req), int(susp), int(blocked), site, vid))
 
             if susp:
                 # алерт только по подозрительным
-                create_alert(con, site, vid, phone, name, score, reasons)
+                create_alert(con, ts, site, vid, phone, name, score, reasons)
 
-        return {"ok": True}
-    finally:
-        con.close()
+    visitor_cache_drop(site, vid)
+    return {"ok": True}
 
 
-@app.get("/risk")
-def risk(site: str, vid: str):
-    con = db()
-    try:
-        site = (site or "").strip()[:200]
-        vid = (vid or "").strip()[:200]
-        if not site or not vid:
-            raise HTTPException(status_code=400, detail="site and vid are required")
-
-        v = get_visitor(con, site, vid)
-        if not v:
-            return {
-                "blocked": False,
-                "suspicious": False,
-                "captcha_required": False,
-                "score": 0,
-                "reasons": [],
-                "history": {"count": 0, "distinct_phones": 0, "distinct_names": 0},
-            }
-
-        phone = v["last_phone"]
-        blocked = is_blocked(con, vid, phone)
+def _risk_snapshot(con, site: str, vid: str) -> Optional[dict]:
+    """То, что /risk отдаёт по визитору (кроме blocked — он живой, из памяти)."""
+    v = get_visitor(con, site, vid)
+    if not v:
+        return None
 
+    reasons = []
+    try:
+        reasons = orjson.loads(v["last_reasons_json"] or "[]")
+    except orjson.JSONDecodeError:
         reasons = []
-        try:
-            reasons = json.loads(v["last_reasons_json"] or "[]")
-        except Exception:
-            reasons = []
 
-        # историю покажем как раньше (тебе удобно)
-        cur = con.cursor()
-        cur.execute("SELECT COUNT(*) as c FROM leads WHERE site=? AND vid=?", (site, vid))
-        count = int(cur.fetchone()["c"])
-        cur.execute("SELECT COUNT(DISTINCT COALESCE(phone,'')) as c FROM leads WHERE site=? AND vid=?", (site, vid))
-        distinct_phones = int(cur.fetchone()["c"])
-        cur.execute("SELECT COUNT(DISTINCT COALESCE(name,'')) as c FROM leads WHERE site=? AND vid=?", (site, vid))
-        distinct_names = int(cur.fetchone()["c"])
+    # историю покажем как раньше (тебе удобно) — теми же счётчиками, что и скоринг
+    history = lead_history_stats(con, site, vid, None)
+
+    return {
+        "phone": v["last_phone"],
+        "suspicious": bool(int(v["suspicious"])),
+        "captcha_required": bool(int(v["captcha_required"])),
+        "score": int(v["last_score"]),
+        "reasons": reasons,
+        "history": {
+            "count": history["vid_count"],
+            "distinct_phones": history["distinct_phones"],
+            "distinct_names": history["distinct_names"]
+        }
+    }
+
 
+@app.get("/risk")
+def risk(site: str, vid: str):
+    site = (site or "").strip()[:200]
+    vid = (vid or "").strip()[:200]
+    if not site or not vid:
+        raise HTTPException(status_code=400, detail="site and vid are required")
+
+    snap = visitor_cache_get(site, vid)
+    if snap is _CACHE_MISS:
+        with db() as con:
+            snap = _risk_snapshot(con, site, vid)
+        visitor_cache_put(site, vid, snap)
+
+    if snap is None:
         return {
-            "blocked": bool(blocked),
-            "suspicious": bool(int(v["suspicious"])),
-            "captcha_required": bool(int(v["captcha_required"])),
-            "score": int(v["last_score"]),
-            "reasons": reasons,
-            "history": {
-                "count": count,
-                "distinct_phones": distinct_phones,
-                "distinct_names": distinct_names
-            }
+            "blocked": False,
+            "suspicious": False,
+            "captcha_required": False,
+            "score": 0,
+            "reasons": [],
+            "history": {"count": 0, "distinct_phones": 0, "distinct_names": 0},
         }
-    finally:
-        con.close()
+
+    return {
+        "blocked": is_blocked(vid, snap["phone"]),
+        "suspicious": snap["suspicious"],
+        "captcha_required": snap["captcha_required"],
+        "score": snap["score"],
+        "reasons": snap["reasons"],
+        "history": snap["history"],
+    }
 
 
 # ---- CAPTCHA (простая математическая, без доменов/turnstile) ----
 
-@app.get("/captcha/new")
-def captcha_new(site: str, vid: str):
-    con = db()
+# Капча без состояния в БД: id = "nonce.exp.hmac", где HMAC подписывает nonce, срок,
+# визитора и правильный ответ. Проверка — пересчитать HMAC; одноразовость —
+# по nonce уже принятых капч, которые держим в памяти до истечения их срока.
+_CAPTCHA_USED: "OrderedDict[str, int]" = OrderedDict()
+_CAPTCHA_USED_MAX = 100_000
+_CAPTCHA_LOCK = threading.Lock()
+
+
+def _captcha_sig(nonce: str, exp: int, vid: str, site: str, answer: str) -> str:
+    msg = f"{nonce}|{exp}|{vid}|{site}|{answer}".encode()
+    return hmac.new(CAPTCHA_SECRET, msg, hashlib.sha256).hexdigest()
+
+
+def captcha_make_id(vid: str, site: str, answer: str) -> str:
+    nonce = secrets.token_urlsafe(12)
+    exp = int(time.time()) + CAPTCHA_TTL_SEC
+    return f"{nonce}.{exp}.{_captcha_sig(nonce, exp, vid, site, answer)}"
+
+
+def captcha_verify(cid: str, vid: str, site: str, answer: str) -> bool:
     try:
-        site = (site or "").strip()[:200]
-        vid = (vid or "").strip()[:200]
-        if not site or not vid:
-            raise HTTPException(status_code=400, detail="site and vid are required")
+        nonce, exp_s, sig = cid.split(".")
+        exp = int(exp_s)
+    except ValueError:
+        return False
+
+    now = int(time.time())
+    if now > exp:
+        return False
+    if not hmac.compare_digest(sig.encode(), _captcha_sig(nonce, exp, vid, site, answer).encode()):
+        return False
+
+    with _CAPTCHA_LOCK:
+        # nonce добавляются примерно в порядке exp — протухшие снимаем с головы
+        while _CAPTCHA_USED and (next(iter(_CAPTCHA_USED.values())) < now or len(_CAPTCHA_USED) >= _CAPTCHA_USED_MAX):
+            _CAPTCHA_USED.popitem(last=False)
+        if nonce in _CAPTCHA_USED:
+            return False
+        _CAPTCHA_USED[nonce] = exp
+    return True
 
-        a = secrets.randbelow(8) + 2   # 2..9
-        b = secrets.randbelow(8) + 2   # 2..9
-        cid = secrets.token_urlsafe(16)
-        q = f"Сколько будет {a}+{b}?"
-        ans = str(a + b)
 
-        cur = con.cursor()
-        cur.execute("""
-            INSERT INTO captcha_challenges (id, ts, vid, site, question, answer)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (cid, int(time.time()), vid, site, q, ans))
-        con.commit()
+@app.get("/captcha/new")
+def captcha_new(site: str, vid: str):
+    site = (site or "").strip()[:200]
+    vid = (vid or "").strip()[:200]
+    if not site or not vid:
+        raise HTTPException(status_code=400, detail="site and vid are required")
 
-        return {"id": cid, "question": q}
-    finally:
-        con.close()
+    a = secrets.randbelow(8) + 2   # 2..9
+    b = secrets.randbelow(8) + 2   # 2..9
+    q = f"Сколько будет {a}+{b}?"
+    cid = captcha_make_id(vid, site, str(a + b))
+
+    return {"id": cid, "question": q}
 
 
 # ---- ADMIN API (для TG-бота) ----
 
+# повторная блокировка обновляет строку на месте; INSERT OR REPLACE
+# удалял её и вставлял заново (две правки B-дерева вместо одной)
+_SQL_UPSERT_BLOCKED_PHONE = """
+    INSERT INTO blocked_phones (phone, ts, reason) VALUES (?, ?, ?)
+    ON CONFLICT (phone) DO UPDATE SET ts=excluded.ts, reason=excluded.reason
+"""
+
+_SQL_UPSERT_BLOCKED_VID = """
+    INSERT INTO blocked_vids (vid, ts, reason, phone) VALUES (?, ?, ?, ?)
+    ON CONFLICT (vid) DO UPDATE SET ts=excluded.ts, reason=excluded.reason, phone=excluded.phone
+"""
+
+_SQL_VIDS_BY_PHONE = "SELECT DISTINCT vid FROM leads WHERE phone=?"
+
+# список vid — одним JSON-параметром: текст запроса не зависит от числа vid,
+# и в кэше выражений остаётся одна запись вместо своей на каждую длину IN (?, ...)
+_SQL_FLAG_BLOCKED_VIDS = "UPDATE visitors SET blocked=1 WHERE vid IN (SELECT value FROM json_each(?))"
+
+
+def block_vids(cur, ts: int, vids: List[str], reason: str, phone: Optional[str]):
+    # все vid одним executemany и одним UPDATE, а не парой запросов на каждый
+    if not vids:
+        return
+    cur.executemany(_SQL_UPSERT_BLOCKED_VID, [(v, ts, reason, phone) for v in vids])
+    cur.execute(_SQL_FLAG_BLOCKED_VIDS, (dumps(vids),))
+
+
 class AdminBlockPhoneIn(BaseModel):
     phone: str
     reason: Optional[str] = None
@@ -598,53 +1223,48 @@ class AdminBlockLeadIn(BaseModel):
 @app.post("/admin/block_phone")
 def admin_block_phone(data: AdminBlockPhoneIn, x_admin_token: Optional[str] = Header(default=None)):
     require_admin(x_admin_token)
-    con = db()
-    try:
-        phone = norm_phone(data.phone)
-        if not phone:
-            raise HTTPException(status_code=400, detail="bad phone")
-        reason = (data.reason or "").strip()[:300] or "blocked via tg"
-
+    # проверки — до write_tx, чтобы плохой запрос не брал блокировку записи
+    phone = norm_phone(data.phone)
+    if not phone:
+        raise HTTPException(status_code=400, detail="bad phone")
+    reason = (data.reason or "").strip()[:300] or "blocked via tg"
+    ts = now_ts()
+
+    with write_tx() as con:
         cur = con.cursor()
-        cur.execute("INSERT OR REPLACE INTO blocked_phones (phone, ts, reason) VALUES (?, ?, ?)",
-                    (phone, now_iso(), reason))
+        cur.execute(_SQL_UPSERT_BLOCKED_PHONE, (phone, ts, reason))
 
         # найдём все vid, кто оставлял заявки с этим телефоном
-        cur.execute("SELECT DISTINCT vid FROM leads WHERE phone=?", (phone,))
-        vids = [r["vid"] for r in cur.fetchall()]
+        cur.execute(_SQL_VIDS_BY_PHONE, (phone,))
+        vids = [r["vid"] for r in cur]
 
-        for v in vids:
-            cur.execute("INSERT OR REPLACE INTO blocked_vids (vid, ts, reason, phone) VALUES (?, ?, ?, ?)",
-                        (v, now_iso(), reason, phone))
-            cur.execute("UPDATE visitors SET blocked=1 WHERE vid=?", (v,))
+        block_vids(cur, ts, vids, reason, phone)
 
-        con.commit()
-        return {"ok": True, "phone": phone, "vids_blocked": len(vids), "vids": vids[:50]}
-    finally:
-        con.close()
+    # в память — только после COMMIT
+    _BLOCKED_PHONES.add(phone)
+    _BLOCKED_VIDS.update(vids)
+    return {"ok": True, "phone": phone, "vids_blocked": len(vids), "vids": vids[:50]}
 
 
 @app.post("/admin/unblock_phone")
 def admin_unblock_phone(data: AdminBlockPhoneIn, x_admin_token: Optional[str] = Header(default=None)):
     require_admin(x_admin_token)
-    con = db()
-    try:
-        phone = norm_phone(data.phone)
-        if not phone:
-            raise HTTPException(status_code=400, detail="bad phone")
+    phone = norm_phone(data.phone)
+    if not phone:
+        raise HTTPException(status_code=400, detail="bad phone")
+
+    with write_tx() as con:
         cur = con.cursor()
         cur.execute("DELETE FROM blocked_phones WHERE phone=?", (phone,))
-        con.commit()
-        return {"ok": True, "phone": phone}
-    finally:
-        con.close()
+
+    _BLOCKED_PHONES.discard(phone)
+    return {"ok": True, "phone": phone}
 
 
 @app.post("/admin/block_lead")
 def admin_block_lead(data: AdminBlockLeadIn, x_admin_token: Optional[str] = Header(default=None)):
     require_admin(x_admin_token)
-    con = db()
-    try:
+    with write_tx() as con:
         cur = con.cursor()
         cur.execute("SELECT * FROM leads WHERE id=? LIMIT 1", (data.lead_id,))
         lead = cur.fetchone()
@@ -654,32 +1274,28 @@ def admin_block_lead(data: AdminBlockLeadIn, x_admin_token: Optional[str] = Head
         phone = lead["phone"]
         vid = lead["vid"]
         reason = (data.reason or "").strip()[:300] or f"blocked by lead_id={data.lead_id}"
+        ts = now_ts()
 
         # блок телефона + связанного vid
         if phone:
-            cur.execute("INSERT OR REPLACE INTO blocked_phones (phone, ts, reason) VALUES (?, ?, ?)",
-                        (phone, now_iso(), reason))
-            cur.execute("SELECT DISTINCT vid FROM leads WHERE phone=?", (phone,))
-            vids = [r["vid"] for r in cur.fetchall()]
+            cur.execute(_SQL_UPSERT_BLOCKED_PHONE, (phone, ts, reason))
+            cur.execute(_SQL_VIDS_BY_PHONE, (phone,))
+            vids = [r["vid"] for r in cur]
         else:
             vids = [vid]
 
-        for v in vids:
-            cur.execute("INSERT OR REPLACE INTO blocked_vids (vid, ts, reason, phone) VALUES (?, ?, ?, ?)",
-                        (v, now_iso(), reason, phone))
-            cur.execute("UPDATE visitors SET blocked=1 WHERE vid=?", (v,))
+        block_vids(cur, ts, vids, reason, phone)
 
-        con.commit()
-        return {"ok": True, "lead_id": data.lead_id, "phone": phone, "vids_blocked": len(vids), "vids": vids[:50]}
-    finally:
-        con.close()
+    if phone:
+        _BLOCKED_PHONES.add(phone)
+    _BLOCKED_VIDS.update(vids)
+    return {"ok": True, "lead_id": data.lead_id, "phone": phone, "vids_blocked": len(vids), "vids": vids[:50]}
 
 
 @app.get("/admin/lookup_phone")
 def admin_lookup_phone(phone: str, x_admin_token: Optional[str] = Header(default=None)):
     require_admin(x_admin_token)
-    con = db()
-    try:
+    with db() as con:
         p = norm_phone(phone)
         if not p:
             raise HTTPException(status_code=400, detail="bad phone")
@@ -691,19 +1307,17 @@ def admin_lookup_phone(phone: str, x_admin_token: Optional[str] = Header(default
             ORDER BY id DESC
             LIMIT 50
         """, (p,))
-        leads = [dict(r) for r in cur.fetchall()]
+        leads = [dict(r) for r in cur]
+        for l in leads:
+            l["ts"] = ts_iso(l["ts"])
 
         vids = sorted(list({l["vid"] for l in leads}))
 
-        cur.execute("SELECT 1 FROM blocked_phones WHERE phone=? LIMIT 1", (p,))
-        phone_blocked = bool(cur.fetchone())
+        # блокировки — из тех же множеств в памяти, что и is_blocked
+        phone_blocked = p in _BLOCKED_PHONES
 
         # какие из этих vids заблокированы
-        blocked_vids = []
-        for v in vids:
-            cur.execute("SELECT 1 FROM blocked_vids WHERE vid=? LIMIT 1", (v,))
-            if cur.fetchone():
-                blocked_vids.append(v)
+        blocked_vids = [v for v in vids if v in _BLOCKED_VIDS]
 
         return {
             "phone": p,
@@ -712,15 +1326,12 @@ def admin_lookup_phone(phone: str, x_admin_token: Optional[str] = Header(default
             "blocked_vids": blocked_vids,
             "leads": leads
         }
-    finally:
-        con.close()
 
 
 @app.get("/admin/alerts")
 def admin_alerts(since_id: int = 0, limit: int = 20, x_admin_token: Optional[str] = Header(default=None)):
     require_admin(x_admin_token)
-    con = db()
-    try:
+    with db() as con:
         cur = con.cursor()
         cur.execute("""
             SELECT * FROM alerts
@@ -728,13 +1339,12 @@ def admin_alerts(since_id: int = 0, limit: int = 20, x_admin_token: Optional[str
             ORDER BY id ASC
             LIMIT ?
         """, (since_id, max(1, min(limit, 100))))
-        rows = [dict(r) for r in cur.fetchall()]
-        # распарсим reasons
+        rows = [dict(r) for r in cur]
+        # распарсим reasons, время — в ISO, как было
         for r in rows:
+            r["ts"] = ts_iso(r["ts"])
             try:
-                r["reasons"] = json.loads(r.get("reasons_json") or "[]")
-            except Exception:
+                r["reasons"] = orjson.loads(r.get("reasons_json") or "[]")
+            except orjson.JSONDecodeError:
                 r["reasons"] = []
         return {"ok": True, "items": rows}
-    finally:
-        con.close()